@@ -0,0 +1,19 @@
+from setuptools import setup
+
+setup(
+    name="vnc",
+    version="0.1.0",
+    description="A VNC server and client written from scratch in Python",
+    packages=["vnc", "vnc.client", "vnc.protocol", "vnc.server"],
+    python_requires=">=3.8",
+    extras_require={
+        "capture": ["mss", "Pillow"],
+        "input": ["pyautogui"],
+    },
+    entry_points={
+        "console_scripts": [
+            "vnc-server=vnc.server.vnc_server:main",
+            "vnc-client=vnc.client.vnc_client:main",
+        ],
+    },
+)
@@ -0,0 +1,10 @@
+"""Make the repository root importable exactly once per test session.
+
+``pip install -e .`` makes this redundant, but keeping the insertion here
+lets the suite run straight from a checkout.
+"""
+
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
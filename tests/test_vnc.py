@@ -0,0 +1,448 @@
+"""Unit and integration tests for the VNC server and protocol."""
+
+import socket
+import struct
+import sys
+import threading
+import unittest
+
+from vnc.protocol.events import EventManager
+from vnc.protocol.rfb import (
+    RFB_VERSION, ClientMessage, EncodingType, FramebufferUpdate,
+    PixelFormat, Rectangle, RFBProtocol, SecurityType, ServerMessage,
+    VNCAuth, rgb888_to_rgb565, rgb888_to_rgb565_array,
+)
+from vnc.server.vnc_server import SERVER_PIXEL_FORMAT, VNCServer
+
+# Precompiled Structs: struct.pack/unpack re-parse the format string on
+# every call, so compile the handful of formats the assertions use once.
+_U8 = struct.Struct("!B")
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+_WH = struct.Struct("!HH")
+_RECT_HDR = struct.Struct("!HHHHi")
+_FBU_HDR = struct.Struct("!BxH")
+
+
+def _free_port():
+    """Grab an ephemeral port from the OS so parallel runs never collide
+    on a hardcoded number."""
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class MockSocket:
+    """A socket double recording sent bytes and replaying queued data."""
+
+    def __init__(self, receive_data=b""):
+        # bytearray.extend is amortized O(len(data)); += on bytes would
+        # recopy everything sent so far on every call.
+        self._buf = bytearray()
+        self._recv_view = memoryview(receive_data)
+        self.recv_pos = 0
+        self.closed = False
+
+    @property
+    def sent_data(self):
+        return bytes(self._buf)
+
+    def sendall(self, data):
+        self._buf.extend(data)
+
+    def recv(self, size):
+        chunk = bytes(self._recv_view[self.recv_pos:self.recv_pos + size])
+        self.recv_pos += len(chunk)
+        return chunk
+
+    def recv_into(self, buffer, nbytes=0, flags=0):
+        limit = nbytes if nbytes else len(buffer)
+        count = min(limit, len(self._recv_view) - self.recv_pos)
+        buffer[:count] = self._recv_view[self.recv_pos:self.recv_pos + count]
+        self.recv_pos += count
+        return count
+
+    def close(self):
+        self.closed = True
+
+
+class TestPixelFormat(unittest.TestCase):
+    def test_default_format(self):
+        pf = PixelFormat()
+        self.assertEqual(pf.bits_per_pixel, 32)
+        self.assertEqual(pf.depth, 24)
+        self.assertEqual(pf.true_colour, 1)
+
+    def test_pack_length(self):
+        self.assertEqual(len(PixelFormat().pack()), 16)
+
+    def test_pack_unpack_roundtrip(self):
+        pf = PixelFormat(bits_per_pixel=16, depth=16, red_max=31,
+                         green_max=63, blue_max=31, red_shift=11,
+                         green_shift=5, blue_shift=0)
+        self.assertEqual(PixelFormat.unpack(pf.pack()), pf)
+
+    def test_pack_cache_invalidation(self):
+        pf = PixelFormat()
+        first = pf.pack()
+        self.assertIs(pf.pack(), first)
+        pf.bits_per_pixel = 16
+        self.assertNotEqual(pf.pack(), first)
+        self.assertEqual(pf.pack()[0], 16)
+
+
+class TestRFBProtocol(unittest.TestCase):
+    def test_send_uint8(self):
+        sock = MockSocket()
+        RFBProtocol(sock).send_uint8(0xAB)
+        self.assertEqual(sock.sent_data, _U8.pack(0xAB))
+
+    def test_send_uint16(self):
+        sock = MockSocket()
+        RFBProtocol(sock).send_uint16(0xABCD)
+        self.assertEqual(sock.sent_data, _U16.pack(0xABCD))
+
+    def test_send_uint32(self):
+        sock = MockSocket()
+        RFBProtocol(sock).send_uint32(0xABCDEF01)
+        self.assertEqual(sock.sent_data, _U32.pack(0xABCDEF01))
+
+    def test_receive_uints(self):
+        sock = MockSocket(_U8.pack(7) + _U16.pack(770) + _U32.pack(70000))
+        protocol = RFBProtocol(sock)
+        self.assertEqual(protocol.receive_uint8(), 7)
+        self.assertEqual(protocol.receive_uint16(), 770)
+        self.assertEqual(protocol.receive_uint32(), 70000)
+
+    def test_receive_data_connection_closed(self):
+        protocol = RFBProtocol(MockSocket(b"abc"))
+        with self.assertRaises(ConnectionError):
+            protocol.receive_data(10)
+
+
+class TestVNCAuth(unittest.TestCase):
+    def test_challenge_size(self):
+        self.assertEqual(len(VNCAuth.make_challenge()),
+                         VNCAuth.CHALLENGE_SIZE)
+
+    def test_encrypt_deterministic(self):
+        challenge = b"\x01" * 16
+        self.assertEqual(VNCAuth.encrypt_challenge(challenge, "pw"),
+                         VNCAuth.encrypt_challenge(challenge, "pw"))
+
+    def test_check_response(self):
+        challenge = VNCAuth.make_challenge()
+        response = VNCAuth.encrypt_challenge(challenge, "secret")
+        self.assertTrue(VNCAuth.check_response(challenge, response,
+                                               "secret"))
+
+    def test_wrong_password_rejected(self):
+        challenge = VNCAuth.make_challenge()
+        response = VNCAuth.encrypt_challenge(challenge, "secret")
+        self.assertFalse(VNCAuth.check_response(challenge, response,
+                                                "wrong"))
+
+    def test_subkeys_match_direct_encryption(self):
+        challenge = b"\xAA" * 16
+        subkeys = VNCAuth.derive_subkeys("secret")
+        self.assertEqual(VNCAuth.encrypt_with_subkeys(challenge, subkeys),
+                         VNCAuth.encrypt_challenge(challenge, "secret"))
+
+
+class TestRectangle(unittest.TestCase):
+    def test_pack_header(self):
+        rect = Rectangle(10, 20, 30, 40, EncodingType.RAW)
+        header = rect.pack_header()
+        self.assertEqual(_RECT_HDR.unpack(header),
+                         (10, 20, 30, 40, 0))
+
+    def test_pack_includes_data(self):
+        rect = Rectangle(0, 0, 1, 1, EncodingType.RAW, b"\x01\x02\x03\x04")
+        self.assertEqual(rect.pack(),
+                         rect.pack_header() + b"\x01\x02\x03\x04")
+
+
+class TestFramebufferUpdate(unittest.TestCase):
+    def test_pack_empty(self):
+        update = FramebufferUpdate()
+        self.assertEqual(update.pack(), _FBU_HDR.pack(0, 0))
+
+    def test_pack_single_rectangle(self):
+        rect = Rectangle(0, 0, 2, 2, EncodingType.RAW, b"\x00" * 16)
+        update = FramebufferUpdate([rect])
+        packed = update.pack()
+        self.assertEqual(packed[:4], _FBU_HDR.pack(0, 1))
+        self.assertEqual(packed[4:], rect.pack())
+
+
+class TestColorConversion(unittest.TestCase):
+    def test_rgb888_to_rgb565(self):
+        # Sweep a strided subset of the full RGB cube and compare the
+        # scalar function against a vectorized reference in one shot.
+        import numpy as np
+
+        r, g, b = np.mgrid[0:256:8, 0:256:8, 0:256:8].reshape(
+            3, -1).astype(np.uint16)
+        ref = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
+        got = np.fromiter(
+            (rgb888_to_rgb565(int(r[i]), int(g[i]), int(b[i]))
+             for i in range(r.size)),
+            dtype=np.uint16, count=r.size)
+        self.assertTrue(np.array_equal(got, ref))
+
+    def test_rgb888_to_rgb565_array(self):
+        import numpy as np
+
+        img = np.random.randint(0, 256, (64, 64, 3), dtype=np.uint8)
+        out = rgb888_to_rgb565_array(img)
+        self.assertEqual(out.shape, (64, 64))
+        self.assertEqual(out.dtype, np.uint16)
+        r = img[..., 0].astype(np.uint16)
+        g = img[..., 1].astype(np.uint16)
+        b = img[..., 2].astype(np.uint16)
+        ref = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
+        self.assertTrue(np.array_equal(out, ref))
+
+    def test_rgb888_to_rgb565_batch(self):
+        import numpy as np
+
+        from vnc.protocol._rgb565 import rgb888_to_rgb565_batch
+
+        img = np.random.randint(0, 256, (256, 256, 3), dtype=np.uint8)
+        out = rgb888_to_rgb565_batch(img)
+        r = img[..., 0].astype(np.uint16)
+        g = img[..., 1].astype(np.uint16)
+        b = img[..., 2].astype(np.uint16)
+        ref = ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
+        self.assertEqual(out.dtype, np.uint16)
+        self.assertTrue(np.array_equal(out, ref))
+
+
+class TestEncodings(unittest.TestCase):
+    def test_encoding_values(self):
+        # one dict comparison: one assertion frame, and a full diff on
+        # mismatch instead of stopping at the first wrong constant
+        self.assertEqual(
+            {name: int(member) for name, member in
+             EncodingType.__members__.items()},
+            {"RAW": 0, "COPYRECT": 1, "RRE": 2, "HEXTILE": 5,
+             "TIGHT": 7, "TRLE": 15, "ZRLE": 16})
+
+
+class TestProtocolMessages(unittest.TestCase):
+    def test_client_message_values(self):
+        self.assertEqual(
+            {name: int(member) for name, member in
+             ClientMessage.__members__.items()},
+            {"SET_PIXEL_FORMAT": 0, "SET_ENCODINGS": 2,
+             "FRAMEBUFFER_UPDATE_REQUEST": 3, "KEY_EVENT": 4,
+             "POINTER_EVENT": 5, "CLIENT_CUT_TEXT": 6})
+
+    def test_server_message_values(self):
+        self.assertEqual(
+            {name: int(member) for name, member in
+             ServerMessage.__members__.items()},
+            {"FRAMEBUFFER_UPDATE": 0, "SET_COLOUR_MAP_ENTRIES": 1,
+             "BELL": 2, "SERVER_CUT_TEXT": 3})
+
+
+class TestSecurityTypes(unittest.TestCase):
+    def test_security_type_values(self):
+        self.assertEqual(
+            {name: int(member) for name, member in
+             SecurityType.__members__.items()},
+            {"INVALID": 0, "NONE": 1, "VNC_AUTH": 2})
+
+
+class TestEventManager(unittest.TestCase):
+    def test_subscribe_and_emit(self):
+        events = EventManager()
+        seen = []
+        events.subscribe("ping", seen.append)
+        events.emit("ping", 42)
+        self.assertEqual(seen, [42])
+
+    def test_unsubscribe(self):
+        events = EventManager()
+        seen = []
+        callback = seen.append
+        events.subscribe("ping", callback)
+        events.unsubscribe("ping", callback)
+        events.emit("ping", 42)
+        self.assertEqual(seen, [])
+
+    def test_emit_without_listeners(self):
+        EventManager().emit("nobody-home")  # must not raise
+
+    def test_listener_exception_does_not_break_others(self):
+        events = EventManager()
+        seen = []
+
+        def bad(_):
+            raise RuntimeError("boom")
+
+        events.subscribe("ping", bad)
+        events.subscribe("ping", seen.append)
+        events.emit("ping", 1)
+        self.assertEqual(seen, [1])
+
+
+class _SharedServerTest(unittest.TestCase):
+    """Base fixture: one server per test class.
+
+    Socket bind + thread spawn + shutdown dominates these tests, so pay
+    for it once per class instead of once per method.  Tests that need
+    start/stop semantics keep their own per-method server.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server_port = _free_port()
+        cls.server = VNCServer("localhost", cls.server_port)
+        cls.server_thread = threading.Thread(target=cls.server.start,
+                                             daemon=True)
+        cls.server_thread.start()
+        if not cls.server._ready.wait(2.0):
+            raise RuntimeError("server did not become ready")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        cls.server_thread.join(timeout=2.0)
+        assert not cls.server_thread.is_alive()
+
+
+class TestVNCServerLifecycle(unittest.TestCase):
+    """Start/stop semantics need a fresh server per test, so this class
+    keeps per-method setup."""
+
+    def setUp(self):
+        self.server_port = _free_port()
+        self.server = VNCServer("localhost", self.server_port)
+        self.server_thread = threading.Thread(target=self.server.start,
+                                              daemon=True)
+        self.server_thread.start()
+        self.assertTrue(self.server._ready.wait(2.0),
+                        "server did not become ready")
+
+    def tearDown(self):
+        self.server.stop()
+        self.server_thread.join(timeout=2.0)
+        self.assertFalse(self.server_thread.is_alive())
+
+    def test_server_start_stop(self):
+        self.assertTrue(self.server.running)
+        self.server.stop()
+        self.server_thread.join(timeout=2.0)
+        self.assertFalse(self.server_thread.is_alive())
+        self.assertFalse(self.server.running)
+
+
+class TestVNCServer(_SharedServerTest):
+    def test_server_attributes(self):
+        self.assertGreater(self.server.screen_width, 0)
+        self.assertGreater(self.server.screen_height, 0)
+        self.assertEqual(len(self.server.clients), 0)
+
+    def test_send_server_init(self):
+        import asyncio
+        from types import SimpleNamespace
+
+        sent = bytearray()
+
+        class _Writer:
+            def write(self, data):
+                sent.extend(data)
+
+            async def drain(self):
+                pass
+
+        class _Reader:
+            async def readexactly(self, n):
+                return b"\x01"[:n]
+
+        client = SimpleNamespace(reader=_Reader(), writer=_Writer())
+        asyncio.run(self.server._do_initialization(client))
+        # unpack_from reads in place; no intermediate slice objects
+        width, height = _WH.unpack_from(sent, 0)
+        self.assertEqual(width, self.server.screen_width)
+        self.assertEqual(height, self.server.screen_height)
+        self.assertEqual(sent[4:20], SERVER_PIXEL_FORMAT.pack())
+        name_length = _U32.unpack_from(sent, 20)[0]
+        self.assertEqual(len(sent), 24 + name_length)
+
+
+class TestIntegration(_SharedServerTest):
+    def _recv_exact(self, sock, size):
+        data = b""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            self.assertTrue(chunk, "connection closed early")
+            data += chunk
+        return data
+
+    def test_basic_connection(self):
+        sock = socket.create_connection(("localhost", self.server_port),
+                                        timeout=2.0)
+        try:
+            # version handshake
+            self.assertEqual(self._recv_exact(sock, 12), RFB_VERSION)
+            sock.sendall(RFB_VERSION)
+            # security: server must offer NONE when no password is set
+            count = self._recv_exact(sock, 1)[0]
+            types = self._recv_exact(sock, count)
+            self.assertIn(int(SecurityType.NONE), types)
+            sock.sendall(bytes([int(SecurityType.NONE)]))
+            result = _U32.unpack(self._recv_exact(sock, 4))[0]
+            self.assertEqual(result, 0)
+            # initialization
+            sock.sendall(b"\x01")  # ClientInit: shared
+            width, height = _WH.unpack(self._recv_exact(sock, 4))
+            self.assertEqual((width, height), (self.server.screen_width,
+                                               self.server.screen_height))
+            self._recv_exact(sock, 16)  # pixel format
+            name_length = _U32.unpack(self._recv_exact(sock, 4))[0]
+            self._recv_exact(sock, name_length)
+            # request and receive one full framebuffer update
+            sock.sendall(struct.pack("!BBHHHH",
+                                     int(ClientMessage
+                                         .FRAMEBUFFER_UPDATE_REQUEST),
+                                     0, 0, 0, width, height))
+            message_type, num_rects = _FBU_HDR.unpack(
+                self._recv_exact(sock, 4))
+            self.assertEqual(message_type,
+                             int(ServerMessage.FRAMEBUFFER_UPDATE))
+            self.assertEqual(num_rects, 1)
+            x, y, w, h, encoding = _RECT_HDR.unpack(
+                self._recv_exact(sock, 12))
+            self.assertEqual((x, y, w, h), (0, 0, width, height))
+            self.assertEqual(encoding, int(EncodingType.RAW))
+            pixels = self._recv_exact(sock, w * h * 4)
+            self.assertEqual(len(pixels), w * h * 4)
+        finally:
+            sock.close()
+
+
+if __name__ == "__main__":
+    # The test classes are independent, so fan them out across a thread
+    # pool: the pure-CPU unit tests overlap with the socket-bound server
+    # and integration tests instead of queueing behind them.
+    from concurrent.futures import ThreadPoolExecutor
+
+    loader = unittest.TestLoader()
+    classes = [
+        TestPixelFormat, TestRFBProtocol, TestVNCAuth, TestRectangle,
+        TestFramebufferUpdate, TestColorConversion, TestEncodings,
+        TestProtocolMessages, TestSecurityTypes, TestEventManager,
+        TestVNCServerLifecycle, TestVNCServer, TestIntegration,
+    ]
+
+    def run_class(cls):
+        runner = unittest.TextTestRunner(verbosity=1)
+        return runner.run(loader.loadTestsFromTestCase(cls))
+
+    with ThreadPoolExecutor() as pool:
+        results = list(pool.map(run_class, classes))
+    sys.exit(0 if all(r.wasSuccessful() for r in results) else 1)
@@ -0,0 +1 @@
+"""A VNC server and client written from scratch in Python."""
@@ -0,0 +1,59 @@
+"""Pixel repacking for server formats QImage cannot render directly.
+
+If the server negotiates a 32-bit format with unusual channel shifts or
+masks (BGR ordering, narrow channels), every pixel has to be rewritten
+before Qt can display it.  With Numba that loop runs as parallel machine
+code; without it a NumPy shift/mask expression is used.  Either way the
+per-pixel Python interpreter loop is avoided.
+"""
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+try:
+    from numba import njit, prange
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+if HAS_NUMBA:
+
+    @njit(parallel=True, boundscheck=False, cache=True)
+    def _repack_kernel(src, dst, r_shift, g_shift, b_shift,
+                       r_max, g_max, b_max):  # pragma: no cover - jitted
+        for i in prange(src.shape[0]):
+            pixel = src[i]
+            r = ((pixel >> r_shift) & r_max) * 255 // r_max
+            g = ((pixel >> g_shift) & g_max) * 255 // g_max
+            b = ((pixel >> b_shift) & b_max) * 255 // b_max
+            dst[i] = 0xFF000000 | (r << 16) | (g << 8) | b
+
+
+def repack_to_rgb32(src, dst, pf):
+    """Rewrite *src* (uint32 pixels in *pf*'s layout) into *dst* as
+    QImage Format_RGB32 (0xffRRGGBB) pixels."""
+    if HAS_NUMBA:
+        _repack_kernel(src, dst, pf.red_shift, pf.green_shift,
+                       pf.blue_shift, pf.red_max, pf.green_max,
+                       pf.blue_max)
+        return dst
+    r = ((src >> pf.red_shift) & pf.red_max).astype(
+        np.uint32) * 255 // pf.red_max
+    g = ((src >> pf.green_shift) & pf.green_max).astype(
+        np.uint32) * 255 // pf.green_max
+    b = ((src >> pf.blue_shift) & pf.blue_max).astype(
+        np.uint32) * 255 // pf.blue_max
+    dst[:] = 0xFF000000 | (r << 16) | (g << 8) | b
+    return dst
+
+
+def warm_up(pf):
+    """Trigger JIT compilation once at connect time so the first real
+    frame does not pay it."""
+    if HAS_NUMPY:
+        dummy = np.zeros(1, dtype=np.uint32)
+        repack_to_rgb32(dummy, np.empty_like(dummy), pf)
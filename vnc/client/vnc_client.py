@@ -0,0 +1,869 @@
+"""A graphical VNC client built on the shared RFB protocol code.
+
+The GUI uses PyQt5 when available; without it the module still imports
+(so the protocol logic can be exercised headless) but the viewer cannot
+be shown.  ``VNCConnection`` owns the socket and the receive loop,
+``VNCWidget`` renders the framebuffer and forwards input.
+"""
+
+import logging
+import socket
+import struct
+import sys
+import threading
+import time
+import zlib
+
+from . import _convert
+from ..protocol.rfb import (
+    RFB_VERSION, ClientMessage, EncodingType, KeySym, PixelFormat,
+    RFBProtocol, SecurityResult, SecurityType, ServerMessage,
+    VNCAuth,
+)
+
+try:
+    from PyQt5.QtCore import QSocketNotifier, Qt, QTimer, pyqtSignal
+    from PyQt5.QtCore import QThread as _ThreadBase
+    from PyQt5.QtGui import QImage, QPainter
+    from PyQt5.QtWidgets import QApplication, QWidget
+    GUI_BACKEND = "PyQt5"
+except ImportError:
+    GUI_BACKEND = None
+    _ThreadBase = threading.Thread
+
+    class QWidget:  # minimal stand-in so the module imports without Qt
+        def __init__(self, *args, **kwargs):
+            pass
+
+logger = logging.getLogger(__name__)
+
+if GUI_BACKEND == "PyQt5":
+    # pixel depths QImage can render without a conversion pass
+    _QIMAGE_FORMATS = {
+        32: QImage.Format_RGB32,
+        24: QImage.Format_RGB888,
+        16: QImage.Format_RGB16,
+    }
+
+if GUI_BACKEND == "PyQt5":
+    # Qt key code -> X11 keysym, built once at import so key events cost
+    # a single dict lookup instead of rebuilding the table per keystroke
+    _QT_TO_KEYSYM = {
+        Qt.Key_Backspace: int(KeySym.BACKSPACE),
+        Qt.Key_Tab: int(KeySym.TAB),
+        Qt.Key_Return: int(KeySym.RETURN),
+        Qt.Key_Enter: int(KeySym.RETURN),
+        Qt.Key_Escape: int(KeySym.ESCAPE),
+        Qt.Key_Insert: int(KeySym.INSERT),
+        Qt.Key_Delete: int(KeySym.DELETE),
+        Qt.Key_Home: int(KeySym.HOME),
+        Qt.Key_End: int(KeySym.END),
+        Qt.Key_PageUp: int(KeySym.PAGE_UP),
+        Qt.Key_PageDown: int(KeySym.PAGE_DOWN),
+        Qt.Key_Left: int(KeySym.LEFT),
+        Qt.Key_Up: int(KeySym.UP),
+        Qt.Key_Right: int(KeySym.RIGHT),
+        Qt.Key_Down: int(KeySym.DOWN),
+        Qt.Key_Shift: int(KeySym.SHIFT_L),
+        Qt.Key_Control: int(KeySym.CONTROL_L),
+        Qt.Key_Alt: int(KeySym.ALT_L),
+        Qt.Key_Meta: int(KeySym.META_L),
+    }
+    for _i in range(12):
+        _QT_TO_KEYSYM[Qt.Key_F1 + _i] = int(KeySym.F1) + _i
+    for _i in range(26):
+        _QT_TO_KEYSYM[Qt.Key_A + _i] = ord("a") + _i
+    for _code in range(Qt.Key_Space, Qt.Key_A):
+        _QT_TO_KEYSYM[_code] = _code
+    for _code in range(Qt.Key_BracketLeft, Qt.Key_AsciiTilde + 1):
+        _QT_TO_KEYSYM[_code] = _code
+
+#: 16-bit 5-6-5 true colour: half the pixel bandwidth of RGB32, and
+#: QImage renders it natively as Format_RGB16
+RGB565_PIXEL_FORMAT = PixelFormat(
+    bits_per_pixel=16, depth=16, big_endian=0, true_colour=1,
+    red_max=31, green_max=63, blue_max=31,
+    red_shift=11, green_shift=5, blue_shift=0)
+
+# Precompiled Structs for the fixed-size message headers.  Reading the
+# whole header in one recv and unpacking it in one call replaces five
+# separate receive_uint16/receive_uint32 round trips per rectangle.
+_UPDATE_HDR = struct.Struct("!xH")
+_RECT_HDR = struct.Struct("!HHHHi")
+_COLOUR_MAP_HDR = struct.Struct("!xHH")
+_CUT_TEXT_HDR = struct.Struct("!3xI")
+
+# Outgoing messages.  Pointer events fire at tens of Hz while dragging,
+# so the pack formats are compiled once rather than re-parsed per event.
+_PTR_EVT = struct.Struct("!BBHH")
+_KEY_EVT = struct.Struct("!BBxxI")
+_FB_REQ = struct.Struct("!BBHHHH")
+_SET_PF = struct.Struct("!Bxxx")
+_SET_ENC_HDR = struct.Struct("!BxH")
+_ENC_ITEM = struct.Struct("!i")
+
+
+class _Signal:
+    """Callback list mimicking the pyqtSignal API for headless use."""
+
+    def __init__(self):
+        self._slots = []
+
+    def connect(self, slot):
+        self._slots.append(slot)
+
+    def emit(self, *args):
+        for slot in self._slots:
+            slot(*args)
+
+
+class VNCConnection(_ThreadBase):
+    """Owns the socket, performs the RFB handshake and runs the receive
+    loop on a dedicated thread."""
+
+    #: seconds between whole-screen update requests; between them the
+    #: client only asks about the region the server last touched
+    FULL_REFRESH_INTERVAL = 2.0
+
+    if GUI_BACKEND == "PyQt5":
+        frame_buffer_updated = pyqtSignal(object)
+        connection_lost = pyqtSignal(str)
+
+    def __init__(self, host, port, password=None, low_bandwidth=False):
+        super().__init__()
+        if GUI_BACKEND != "PyQt5":
+            self.frame_buffer_updated = _Signal()
+            self.connection_lost = _Signal()
+        self.host = host
+        self.port = port
+        self.password = password
+        # DES subkeys depend only on the password; derive them once and
+        # reuse them for every challenge this connection answers
+        self._des_subkeys = (VNCAuth.derive_subkeys(password)
+                             if password is not None else None)
+        self.low_bandwidth = low_bandwidth
+        self.socket = None
+        self.protocol = None
+        self.pixel_format = None
+        self.screen_width = 0
+        self.screen_height = 0
+        self.server_name = ""
+        self.running = False
+        self._last_full_request = 0.0
+        self._fb = None
+        self._fb_mv = None
+        self._qimage = None
+        # outgoing messages queued within one event-loop turn are sent
+        # with a single sendall
+        self._out = bytearray()
+        # ZRLE mandates one zlib stream for the whole connection
+        self._zlib_decompressor = None
+        self._decoders = {
+            int(EncodingType.RAW): self._decode_raw,
+            int(EncodingType.COPYRECT): self._decode_copyrect,
+            int(EncodingType.HEXTILE): self._decode_hextile,
+            int(EncodingType.ZRLE): self._decode_zrle,
+        }
+        self.logger = logger
+
+    # -- connection setup -------------------------------------------------
+
+    def connect_to_server(self):
+        self.socket = socket.create_connection((self.host, self.port),
+                                               timeout=10.0)
+        # no Nagle stall on pointer/key events; a deep receive buffer
+        # for framebuffer bursts; keepalive to notice dead servers
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+        self.socket.settimeout(None)  # idle sessions must not time out
+        self.protocol = RFBProtocol(self.socket)
+        self._do_handshake()
+        self._do_initialization()
+        if self.low_bandwidth:
+            self._send_set_pixel_format(RGB565_PIXEL_FORMAT)
+        self._zlib_decompressor = zlib.decompressobj()
+        # preference order; TIGHT is omitted because there is no decoder
+        # for it here yet
+        self._send_set_encodings([
+            EncodingType.ZRLE, EncodingType.HEXTILE,
+            EncodingType.COPYRECT, EncodingType.RAW])
+        self._request_framebuffer_update(False, 0, 0, self.screen_width,
+                                         self.screen_height)
+        self.running = True
+
+    def _do_handshake(self):
+        version = self.protocol.receive_data(12)
+        if not version.startswith(b"RFB "):
+            raise ConnectionError(f"not an RFB server: {version!r}")
+        self.protocol.send_data(RFB_VERSION)
+
+        count = self.protocol.receive_uint8()
+        if count == 0:
+            reason_length = self.protocol.receive_uint32()
+            reason = self.protocol.receive_data(reason_length)
+            raise ConnectionError(f"server refused connection: "
+                                  f"{reason.decode('latin-1')}")
+        types = self.protocol.receive_data(count)
+
+        if SecurityType.NONE in types:
+            self.protocol.send_uint8(SecurityType.NONE)
+        elif SecurityType.VNC_AUTH in types:
+            if self.password is None:
+                raise ConnectionError("server requires a password")
+            self.protocol.send_uint8(SecurityType.VNC_AUTH)
+            challenge = self.protocol.receive_data(VNCAuth.CHALLENGE_SIZE)
+            response = VNCAuth.encrypt_with_subkeys(challenge,
+                                                    self._des_subkeys)
+            self.protocol.send_data(response)
+        else:
+            raise ConnectionError(f"no supported security type in "
+                                  f"{list(types)}")
+
+        result = self.protocol.receive_uint32()
+        if result != SecurityResult.OK:
+            raise ConnectionError("authentication failed")
+
+    def _do_initialization(self):
+        self.protocol.send_uint8(1)  # ClientInit: request a shared session
+        self.screen_width = self.protocol.receive_uint16()
+        self.screen_height = self.protocol.receive_uint16()
+        self.pixel_format = PixelFormat.unpack(
+            self.protocol.receive_data(16))
+        name_length = self.protocol.receive_uint32()
+        self.server_name = self.protocol.receive_data(
+            name_length).decode("latin-1")
+        self._allocate_framebuffer()
+        self.logger.info("Desktop: %s (%dx%d)", self.server_name,
+                         self.screen_width, self.screen_height)
+
+    def _allocate_framebuffer(self):
+        """(Re)allocate the persistent client-side framebuffer.
+
+        Rectangles are written into this one buffer and the QImage
+        handed to the widget aliases it, so no per-frame pixel
+        allocation happens after this point.
+        """
+        pf = self.pixel_format
+        bpp = pf.bits_per_pixel // 8
+        # cached per-format values for the per-rectangle hot path
+        self._bpp = bpp
+        self._qformat = (_QIMAGE_FORMATS.get(pf.bits_per_pixel)
+                         if GUI_BACKEND == "PyQt5" else None)
+        self._fb = bytearray(self.screen_width * self.screen_height * bpp)
+        self._fb_mv = memoryview(self._fb)
+        # 32bpp layouts other than 0xRRGGBB (BGR ordering, narrow
+        # channels) need a repack pass before QImage can render them
+        self._needs_repack = (
+            bpp == 4 and _convert.HAS_NUMPY and
+            ((pf.red_shift, pf.green_shift, pf.blue_shift) != (16, 8, 0)
+             or (pf.red_max, pf.green_max, pf.blue_max) != (255, 255, 255)))
+        if self._needs_repack:
+            import numpy as np
+            self._rgb32 = np.empty(
+                self.screen_width * self.screen_height, dtype=np.uint32)
+            _convert.warm_up(pf)
+        else:
+            self._rgb32 = None
+        if _convert.HAS_NUMPY:
+            import numpy as np
+            # 2-D byte view of the framebuffer for strided rect blits
+            self._fb_rows = np.frombuffer(self._fb, dtype=np.uint8).reshape(
+                self.screen_height, self.screen_width * bpp)
+        else:
+            self._fb_rows = None
+        self._qimage = self._build_qimage()
+
+    def _build_qimage(self):
+        """One QImage aliasing the framebuffer for the whole session;
+        rectangle blits mutate the pixels it displays in place."""
+        if GUI_BACKEND != "PyQt5":
+            return None
+        if self._needs_repack:
+            return QImage(self._rgb32, self.screen_width,
+                          self.screen_height, self.screen_width * 4,
+                          QImage.Format_RGB32)
+        if self._qformat is None:
+            raise ValueError(f"no QImage format for "
+                             f"{self.pixel_format.bits_per_pixel} bpp")
+        return QImage(self._fb, self.screen_width, self.screen_height,
+                      self.screen_width * self._bpp, self._qformat)
+
+    @property
+    def image(self):
+        """The persistent framebuffer QImage (None without Qt)."""
+        return self._qimage
+
+    # -- receive loop -----------------------------------------------------
+
+    def start_receiving(self):
+        """Begin processing server messages.
+
+        With Qt the socket is watched by a QSocketNotifier on the main
+        event loop: no receive thread, no GIL hand-offs, and signal
+        emissions to the widget are same-thread direct calls instead of
+        queued cross-thread dispatches.  Without Qt, fall back to the
+        blocking thread loop.
+        """
+        if GUI_BACKEND == "PyQt5":
+            self._notifier = QSocketNotifier(
+                self.socket.fileno(), QSocketNotifier.Read, self)
+            self._notifier.activated.connect(self._on_socket_ready)
+        else:
+            self.start()
+
+    def _on_socket_ready(self):
+        try:
+            self._process_one_message()
+            # drain whatever is already buffered so a burst of messages
+            # does not wait for one notifier tick each
+            while self.running and self.protocol.buffered:
+                self._process_one_message()
+        except (ConnectionError, OSError) as exc:
+            self._notifier.setEnabled(False)
+            if self.running:
+                self.running = False
+                self.connection_lost.emit(str(exc))
+
+    def _process_one_message(self):
+        message_type = self.protocol.receive_uint8()
+        if message_type == ServerMessage.FRAMEBUFFER_UPDATE:
+            self._handle_framebuffer_update()
+        elif message_type == ServerMessage.SET_COLOUR_MAP_ENTRIES:
+            self._handle_set_colour_map()
+        elif message_type == ServerMessage.BELL:
+            pass
+        elif message_type == ServerMessage.SERVER_CUT_TEXT:
+            self._handle_server_cut_text()
+        else:
+            self.logger.warning("Unknown server message: %d",
+                                message_type)
+
+    def run(self):
+        try:
+            while self.running:
+                self._process_one_message()
+        except (ConnectionError, OSError) as exc:
+            if self.running:
+                self.connection_lost.emit(str(exc))
+        finally:
+            self.running = False
+
+    def _handle_framebuffer_update(self):
+        # one read + one unpack for the message header, and likewise for
+        # each 12-byte rectangle header
+        buf = self.protocol.receive_data(_UPDATE_HDR.size)
+        (num_rectangles,) = _UPDATE_HDR.unpack_from(buf, 0)
+        min_x = min_y = 65535
+        max_x2 = max_y2 = 0
+        for _ in range(num_rectangles):
+            hdr = self.protocol.receive_data(_RECT_HDR.size)
+            x, y, width, height, encoding = _RECT_HDR.unpack_from(hdr, 0)
+            decoder = self._decoders.get(encoding)
+            if decoder is None:
+                raise ConnectionError(
+                    f"server sent unsupported encoding {encoding}")
+            decoder(x, y, width, height, self._bpp)
+            if x < min_x:
+                min_x = x
+            if y < min_y:
+                min_y = y
+            if x + width > max_x2:
+                max_x2 = x + width
+            if y + height > max_y2:
+                max_y2 = y + height
+        if num_rectangles and max_x2 > min_x:
+            if self._needs_repack:
+                self._run_repack()
+            # one signal per server message, carrying the dirty union so
+            # the widget can repaint just that region
+            self.frame_buffer_updated.emit(
+                (min_x, min_y, max_x2 - min_x, max_y2 - min_y))
+        self._request_next_update(min_x, min_y, max_x2, max_y2)
+
+    def _run_repack(self):
+        import numpy as np
+        src = np.frombuffer(self._fb, dtype=np.uint32)
+        _convert.repack_to_rgb32(src, self._rgb32, self.pixel_format)
+
+    # -- rectangle decoders -----------------------------------------------
+
+    def _decode_raw(self, x, y, width, height, bpp):
+        # the framebuffer stores wire-format pixels (repacking happens on
+        # the display side), so Raw decode is a straight copy from the
+        # socket into the framebuffer with no intermediate buffer
+        stride = self.screen_width * bpp
+        recv = self.protocol.recv_exact_into
+        if x == 0 and width == self.screen_width:
+            offset = y * stride
+            size = height * stride
+            recv(self._fb_mv[offset:offset + size], size)
+            return
+        row_bytes = width * bpp
+        for row in range(y, y + height):
+            offset = row * stride + x * bpp
+            recv(self._fb_mv[offset:offset + row_bytes], row_bytes)
+
+    def _decode_copyrect(self, x, y, width, height, bpp):
+        src_x = self.protocol.receive_uint16()
+        src_y = self.protocol.receive_uint16()
+        stride = self.screen_width * bpp
+        row_bytes = width * bpp
+        # copy through a snapshot of the source region so overlapping
+        # moves within the shared framebuffer stay correct
+        src = bytes(b"".join(
+            self._fb_mv[(src_y + row) * stride + src_x * bpp:
+                        (src_y + row) * stride + src_x * bpp + row_bytes]
+            for row in range(height)))
+        self._blit_rect(src, x, y, width, height, bpp)
+
+    def _decode_hextile(self, x, y, width, height, bpp):
+        background = b"\x00" * bpp
+        foreground = b"\x00" * bpp
+        for ty in range(y, y + height, 16):
+            th = min(16, y + height - ty)
+            for tx in range(x, x + width, 16):
+                tw = min(16, x + width - tx)
+                sub = self.protocol.receive_uint8()
+                if sub & 1:  # raw tile
+                    tile = self.protocol.receive_data(tw * th * bpp)
+                    self._blit_rect(tile, tx, ty, tw, th, bpp)
+                    continue
+                if sub & 2:  # background specified
+                    background = self.protocol.receive_data(bpp)
+                if sub & 4:  # foreground specified
+                    foreground = self.protocol.receive_data(bpp)
+                tile = bytearray(background * (tw * th))
+                if sub & 8:  # any subrects
+                    coloured = sub & 16
+                    count = self.protocol.receive_uint8()
+                    for _ in range(count):
+                        if coloured:
+                            colour = self.protocol.receive_data(bpp)
+                        else:
+                            colour = foreground
+                        xy = self.protocol.receive_uint8()
+                        wh = self.protocol.receive_uint8()
+                        sx, sy = xy >> 4, xy & 0xF
+                        sw, sh = (wh >> 4) + 1, (wh & 0xF) + 1
+                        for row in range(sy, sy + sh):
+                            start = (row * tw + sx) * bpp
+                            tile[start:start + sw * bpp] = colour * sw
+                self._blit_rect(tile, tx, ty, tw, th, bpp)
+
+    def _zrle_cpixel(self, bpp):
+        """ZRLE "compressed pixel" size: 32bpp true-colour formats whose
+        colour fits in the three low-order bytes travel as 3 bytes."""
+        pf = self.pixel_format
+        if (bpp == 4 and pf.true_colour and pf.depth <= 24
+                and not pf.big_endian):
+            fits = all(shift + maximum.bit_length() <= 24
+                       for shift, maximum in
+                       ((pf.red_shift, pf.red_max),
+                        (pf.green_shift, pf.green_max),
+                        (pf.blue_shift, pf.blue_max)))
+            if fits:
+                return 3
+        return bpp
+
+    @staticmethod
+    def _cpixel_to_pixel(cdata, cpixel, bpp):
+        """Expand a run of CPIXELs back to full-size pixels."""
+        if cpixel == bpp:
+            return bytes(cdata)
+        out = bytearray(len(cdata) // cpixel * bpp)
+        pos = 0
+        for i in range(0, len(cdata), cpixel):
+            out[pos:pos + cpixel] = cdata[i:i + cpixel]
+            pos += bpp
+        return bytes(out)
+
+    def _decode_zrle(self, x, y, width, height, bpp):
+        length = self.protocol.receive_uint32()
+        compressed = self.protocol.receive_data(length)
+        raw = self._zlib_decompressor.decompress(compressed)
+        cpixel = self._zrle_cpixel(bpp)
+        pos = 0
+        for ty in range(y, y + height, 64):
+            th = min(64, y + height - ty)
+            for tx in range(x, x + width, 64):
+                tw = min(64, x + width - tx)
+                sub = raw[pos]
+                pos += 1
+                tile, pos = self._zrle_tile(raw, pos, sub, tw, th,
+                                            cpixel, bpp)
+                self._blit_rect(tile, tx, ty, tw, th, bpp)
+
+    def _zrle_tile(self, raw, pos, sub, tw, th, cpixel, bpp):
+        """Decode one ZRLE tile, returning (pixels, new_offset)."""
+        count = tw * th
+        if sub == 0:  # raw
+            size = count * cpixel
+            tile = self._cpixel_to_pixel(raw[pos:pos + size], cpixel, bpp)
+            return tile, pos + size
+        if sub == 1:  # solid colour
+            colour = self._cpixel_to_pixel(raw[pos:pos + cpixel],
+                                           cpixel, bpp)
+            return colour * count, pos + cpixel
+        if 2 <= sub <= 16:  # packed palette
+            palette = [self._cpixel_to_pixel(
+                raw[pos + i * cpixel:pos + (i + 1) * cpixel], cpixel, bpp)
+                for i in range(sub)]
+            pos += sub * cpixel
+            bits = 1 if sub <= 2 else 2 if sub <= 4 else 4
+            tile = bytearray(count * bpp)
+            out = 0
+            for _row in range(th):
+                shift = 8 - bits
+                byte = 0
+                for col in range(tw):
+                    if shift == 8 - bits:
+                        byte = raw[pos]
+                        pos += 1
+                    index = (byte >> shift) & ((1 << bits) - 1)
+                    tile[out:out + bpp] = palette[index]
+                    out += bpp
+                    shift -= bits
+                    if shift < 0 and col != tw - 1:
+                        shift = 8 - bits
+            return bytes(tile), pos
+        if sub == 128:  # plain RLE
+            tile = bytearray(count * bpp)
+            out = 0
+            while out < count * bpp:
+                colour = self._cpixel_to_pixel(raw[pos:pos + cpixel],
+                                               cpixel, bpp)
+                pos += cpixel
+                run = 1
+                while raw[pos] == 255:
+                    run += 255
+                    pos += 1
+                run += raw[pos]
+                pos += 1
+                tile[out:out + run * bpp] = colour * run
+                out += run * bpp
+            return bytes(tile), pos
+        if sub >= 130:  # palette RLE
+            size = sub - 128
+            palette = [self._cpixel_to_pixel(
+                raw[pos + i * cpixel:pos + (i + 1) * cpixel], cpixel, bpp)
+                for i in range(size)]
+            pos += size * cpixel
+            tile = bytearray(count * bpp)
+            out = 0
+            while out < count * bpp:
+                index = raw[pos]
+                pos += 1
+                run = 1
+                if index & 0x80:
+                    index &= 0x7F
+                    while raw[pos] == 255:
+                        run += 255
+                        pos += 1
+                    run += raw[pos]
+                    pos += 1
+                tile[out:out + run * bpp] = palette[index] * run
+                out += run * bpp
+            return bytes(tile), pos
+        raise ConnectionError(f"invalid ZRLE subencoding {sub}")
+
+    def _blit_rect(self, pixel_data, x, y, width, height, bpp):
+        """Copy a decoded rectangle into the persistent framebuffer."""
+        stride = self.screen_width * bpp
+        row_bytes = width * bpp
+        if x == 0 and width == self.screen_width:
+            offset = y * stride
+            self._fb_mv[offset:offset + len(pixel_data)] = pixel_data
+            return
+        if self._fb_rows is not None:
+            # one strided copy instead of a Python loop per scanline
+            import numpy as np
+            self._fb_rows[y:y + height, x * bpp:x * bpp + row_bytes] = \
+                np.frombuffer(pixel_data, dtype=np.uint8).reshape(
+                    height, row_bytes)
+            return
+        src = memoryview(pixel_data)
+        for row in range(height):
+            offset = (y + row) * stride + x * bpp
+            self._fb_mv[offset:offset + row_bytes] = \
+                src[row * row_bytes:(row + 1) * row_bytes]
+
+    def _request_next_update(self, min_x, min_y, max_x2, max_y2):
+        """Ask for the next incremental update over the union of what
+        just changed, with a periodic whole-screen request as a safety
+        net for changes outside the last dirty region."""
+        now = time.monotonic()
+        if (now - self._last_full_request >= self.FULL_REFRESH_INTERVAL
+                or max_x2 <= min_x or max_y2 <= min_y):
+            self._last_full_request = now
+            self._request_framebuffer_update(
+                True, 0, 0, self.screen_width, self.screen_height)
+        else:
+            self._request_framebuffer_update(
+                True, min_x, min_y, max_x2 - min_x, max_y2 - min_y)
+
+    def _handle_set_colour_map(self):
+        buf = self.protocol.receive_data(_COLOUR_MAP_HDR.size)
+        _first, count = _COLOUR_MAP_HDR.unpack_from(buf, 0)
+        self.protocol.receive_data(6 * count)  # ignored: true colour only
+
+    def _handle_server_cut_text(self):
+        buf = self.protocol.receive_data(_CUT_TEXT_HDR.size)
+        (length,) = _CUT_TEXT_HDR.unpack_from(buf, 0)
+        text = self.protocol.receive_data(length).decode("latin-1")
+        # avoid building the preview slice unless INFO is actually on
+        if self.logger.isEnabledFor(logging.INFO):
+            self.logger.info("Server clipboard: %s...", text[:50])
+
+    # -- outgoing messages ------------------------------------------------
+
+    def _queue_message(self, data):
+        """Batch an outgoing message; a burst of events in one Qt
+        event-loop turn (keystroke plus pointer plus update request)
+        leaves in one sendall instead of one syscall each."""
+        if GUI_BACKEND != "PyQt5":
+            # no event loop to defer to; send straight away
+            self.protocol.send_data(data)
+            return
+        if not self._out:
+            QTimer.singleShot(0, self._flush_out)
+        self._out += data
+
+    def _flush_out(self):
+        if not self._out:
+            return
+        data = bytes(self._out)
+        self._out.clear()
+        try:
+            self.socket.sendall(data)
+        except OSError as exc:
+            if self.running:
+                self.running = False
+                self.connection_lost.emit(str(exc))
+
+    def _send_set_encodings(self, encodings):
+        # pack into one preallocated buffer; += on bytes would recopy
+        # the message for every encoding appended
+        count = len(encodings)
+        buf = bytearray(_SET_ENC_HDR.size + _ENC_ITEM.size * count)
+        _SET_ENC_HDR.pack_into(buf, 0, int(ClientMessage.SET_ENCODINGS),
+                               count)
+        for index, encoding in enumerate(encodings):
+            _ENC_ITEM.pack_into(buf, _SET_ENC_HDR.size +
+                                _ENC_ITEM.size * index, int(encoding))
+        self._queue_message(bytes(buf))
+
+    def _send_set_pixel_format(self, pixel_format):
+        self._queue_message(
+            _SET_PF.pack(int(ClientMessage.SET_PIXEL_FORMAT)) +
+            pixel_format.pack())
+        self.pixel_format = pixel_format
+        self._allocate_framebuffer()
+
+    def _request_framebuffer_update(self, incremental, x, y, width,
+                                    height):
+        self._queue_message(_FB_REQ.pack(
+            int(ClientMessage.FRAMEBUFFER_UPDATE_REQUEST),
+            1 if incremental else 0, x, y, width, height))
+
+    def send_key_event(self, keysym, down):
+        self._queue_message(_KEY_EVT.pack(
+            int(ClientMessage.KEY_EVENT), 1 if down else 0, keysym))
+
+    def send_pointer_event(self, x, y, button_mask):
+        self._queue_message(_PTR_EVT.pack(
+            int(ClientMessage.POINTER_EVENT), button_mask, x, y))
+
+    def close(self):
+        self.running = False
+        if self.socket is not None:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+
+
+class VNCWidget(QWidget):
+    """Renders the remote framebuffer and forwards keyboard/mouse
+    input to the server."""
+
+    def __init__(self, connection, parent=None):
+        super().__init__(parent)
+        self.connection = connection
+        self._image = None
+        self._scaled = None
+        self._scaled_for_size = None
+        self._pending_mouse = None
+        if GUI_BACKEND == "PyQt5":
+            # Qt delivers mouse moves at >100 Hz; coalesce them to ~60 Hz
+            # and only ship the latest position
+            self._mouse_timer = QTimer(self)
+            self._mouse_timer.setInterval(16)
+            self._mouse_timer.setSingleShot(True)
+            self._mouse_timer.timeout.connect(self._flush_mouse)
+            self.setFocusPolicy(Qt.StrongFocus)
+            self.setMouseTracking(True)
+            # the framebuffer covers every pixel we own, so skip Qt's
+            # background fill before each paint
+            self.setAttribute(Qt.WA_OpaquePaintEvent)
+            self.setAutoFillBackground(False)
+            self.resize(connection.screen_width, connection.screen_height)
+            self._image = connection.image
+            connection.frame_buffer_updated.connect(self.update_framebuffer)
+
+    def update_framebuffer(self, dirty):
+        # the persistent image aliases the connection's framebuffer; only
+        # the dirty union needs compositing
+        x, y, width, height = dirty
+        self._image = self.connection.image
+        self._scaled = None
+        if self.size() == self._image.size():
+            self.update(x, y, width, height)
+            return
+        # map the dirty rect through the display scale, padded a pixel
+        # to cover rounding; KeepAspectRatio means both axes share the
+        # smaller of the two factors
+        scale = min(self.width() / self._image.width(),
+                    self.height() / self._image.height())
+        self.update(int(x * scale) - 1, int(y * scale) - 1,
+                    int(width * scale) + 3, int(height * scale) + 3)
+
+    def paintEvent(self, event):
+        if self._image is None:
+            return
+        # rescale only when the source frame or widget size changed,
+        # and with the cheap nearest-neighbour filter: a bilinear pass
+        # over a full desktop per paint is CPU we cannot spare
+        if self._scaled is None or self._scaled_for_size != self.size():
+            self._scaled = self._image.scaled(
+                self.size(), Qt.KeepAspectRatio, Qt.FastTransformation)
+            self._scaled_for_size = self.size()
+        painter = QPainter(self)
+        painter.drawImage(0, 0, self._scaled)
+        # WA_OpaquePaintEvent skips Qt's background fill, so the
+        # letterbox margins outside the aspect-fit image are ours to
+        # paint too
+        if self._scaled.width() < self.width():
+            painter.fillRect(self._scaled.width(), 0,
+                             self.width() - self._scaled.width(),
+                             self.height(), Qt.black)
+        if self._scaled.height() < self.height():
+            painter.fillRect(0, self._scaled.height(),
+                             self.width(), self.height() - self._scaled.height(),
+                             Qt.black)
+
+    # -- input forwarding -------------------------------------------------
+
+    def _button_mask(self, buttons):
+        mask = 0
+        if buttons & Qt.LeftButton:
+            mask |= 1
+        if buttons & Qt.MidButton:
+            mask |= 2
+        if buttons & Qt.RightButton:
+            mask |= 4
+        return mask
+
+    def _map_to_frame(self, x, y):
+        # paintEvent draws the frame aspect-fit-scaled at (0,0), so
+        # input coordinates go through the inverse of that same scale,
+        # clamped to the framebuffer (the letterbox margins map to its
+        # nearest edge)
+        image = self._image
+        if image is None or self.size() == image.size():
+            return x, y
+        scale = min(self.width() / image.width(),
+                    self.height() / image.height())
+        return (min(max(int(x / scale), 0), image.width() - 1),
+                min(max(int(y / scale), 0), image.height() - 1))
+
+    def _flush_mouse(self):
+        if self._pending_mouse is None:
+            return
+        x, y, mask = self._pending_mouse
+        self._pending_mouse = None
+        self.connection.send_pointer_event(x, y, mask)
+
+    def mouseMoveEvent(self, event):
+        x, y = self._map_to_frame(event.x(), event.y())
+        self._pending_mouse = (x, y, self._button_mask(event.buttons()))
+        if not self._mouse_timer.isActive():
+            self._mouse_timer.start()
+
+    def mousePressEvent(self, event):
+        # button transitions must not be delayed or reordered behind a
+        # coalesced move, so flush any pending position first
+        self._flush_mouse()
+        x, y = self._map_to_frame(event.x(), event.y())
+        self.connection.send_pointer_event(
+            x, y, self._button_mask(event.buttons()))
+
+    def mouseReleaseEvent(self, event):
+        self._flush_mouse()
+        x, y = self._map_to_frame(event.x(), event.y())
+        self.connection.send_pointer_event(
+            x, y, self._button_mask(event.buttons()))
+
+    def keyPressEvent(self, event):
+        keysym = self._qt_key_to_keysym(event.key())
+        if keysym is not None:
+            self.connection.send_key_event(keysym, True)
+
+    def keyReleaseEvent(self, event):
+        keysym = self._qt_key_to_keysym(event.key())
+        if keysym is not None:
+            self.connection.send_key_event(keysym, False)
+
+    @staticmethod
+    def _qt_key_to_keysym(qt_key):
+        return _QT_TO_KEYSYM.get(qt_key)
+
+
+if GUI_BACKEND != "PyQt5":
+    # Without Qt the event handlers can never do useful work; select
+    # no-op bodies once at import instead of branching on the backend
+    # inside every handler call.
+    def _noop_event(self, *args, **kwargs):
+        return None
+
+    VNCWidget.paintEvent = _noop_event
+    VNCWidget.mouseMoveEvent = _noop_event
+    VNCWidget.mousePressEvent = _noop_event
+    VNCWidget.mouseReleaseEvent = _noop_event
+    VNCWidget.keyPressEvent = _noop_event
+    VNCWidget.keyReleaseEvent = _noop_event
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="VNC client")
+    parser.add_argument("host")
+    parser.add_argument("--port", type=int, default=5900)
+    parser.add_argument("--password", default=None)
+    parser.add_argument("--low-bandwidth", action="store_true",
+                        help="request 16-bit RGB565 pixels")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if GUI_BACKEND != "PyQt5":
+        print("PyQt5 is required to run the viewer "
+              "(pip install PyQt5)", file=sys.stderr)
+        return 1
+
+    app = QApplication(sys.argv)
+    connection = VNCConnection(args.host, args.port, args.password,
+                               low_bandwidth=args.low_bandwidth)
+    connection.connect_to_server()
+    widget = VNCWidget(connection)
+    widget.setWindowTitle(connection.server_name)
+    widget.show()
+    connection.start_receiving()
+    try:
+        return app.exec_()
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1 @@
+"""Protocol-level building blocks for the VNC server and client."""
@@ -0,0 +1,57 @@
+"""A small publish/subscribe event manager used to decouple the VNC server
+from input/output side effects (logging, input injection, session hooks).
+
+Listeners for an event are stored as an immutable tuple.  ``emit`` only has
+to read one reference to get a stable snapshot of the callback list, so the
+hot path (pointer events fire dozens of times per second) performs no
+allocation and takes no lock.  Subscribe/unsubscribe are rare; they rebuild
+the tuple under a lock.
+"""
+
+import logging
+import threading
+from typing import Callable, Dict, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class EventManager:
+    """Thread-safe event dispatcher with allocation-free emit."""
+
+    def __init__(self):
+        # event name -> immutable snapshot of subscribed callbacks
+        self.listeners: Dict[str, Tuple[Callable, ...]] = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, event: str, callback: Callable) -> None:
+        """Register *callback* to be invoked whenever *event* is emitted."""
+        with self._lock:
+            current = self.listeners.get(event, ())
+            self.listeners[event] = current + (callback,)
+
+    def unsubscribe(self, event: str, callback: Callable) -> None:
+        """Remove a previously subscribed callback.  Unknown callbacks are
+        ignored."""
+        with self._lock:
+            current = self.listeners.get(event, ())
+            updated = tuple(cb for cb in current if cb is not callback)
+            if updated:
+                self.listeners[event] = updated
+            else:
+                self.listeners.pop(event, None)
+
+    def emit(self, event: str, *args, **kwargs) -> None:
+        """Invoke every callback subscribed to *event*.
+
+        Reading the tuple out of the dict is atomic under the GIL, so no
+        lock or copy is needed: concurrent (un)subscribes swap in a new
+        tuple and never mutate the one we are iterating.
+        """
+        callbacks = self.listeners.get(event)
+        if not callbacks:
+            return
+        for callback in callbacks:
+            try:
+                callback(*args, **kwargs)
+            except Exception:
+                logger.exception("error in %r listener %r", event, callback)
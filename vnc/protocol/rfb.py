@@ -0,0 +1,380 @@
+"""RFB (Remote Framebuffer) protocol primitives shared by the VNC server
+and client.
+
+Implements the subset of RFB 3.8 needed for a working VNC session:
+handshake constants, pixel formats, message/encoding type numbers,
+rectangle and framebuffer-update framing, VNC challenge authentication,
+and a thin blocking wrapper over a socket for reading/writing protocol
+fields.
+"""
+
+import os
+import socket as _socket
+import struct
+from enum import IntEnum
+from typing import List, Optional
+
+from . import des
+
+try:
+    import numpy as np
+    HAS_NUMPY = True
+except ImportError:
+    HAS_NUMPY = False
+
+RFB_VERSION = b"RFB 003.008\n"
+
+# Precompiled Structs for the fixed-size protocol fields.  struct.pack
+# re-parses its format string on every call; compiling once at import
+# removes that from the per-message send/receive paths.
+_U8 = struct.Struct("!B")
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+_RECT_HDR = struct.Struct("!HHHHi")
+_FBU_HDR = struct.Struct("!BxH")
+
+
+class SecurityType(IntEnum):
+    INVALID = 0
+    NONE = 1
+    VNC_AUTH = 2
+
+
+class SecurityResult(IntEnum):
+    OK = 0
+    FAILED = 1
+
+
+class ClientMessage(IntEnum):
+    SET_PIXEL_FORMAT = 0
+    SET_ENCODINGS = 2
+    FRAMEBUFFER_UPDATE_REQUEST = 3
+    KEY_EVENT = 4
+    POINTER_EVENT = 5
+    CLIENT_CUT_TEXT = 6
+
+
+class ServerMessage(IntEnum):
+    FRAMEBUFFER_UPDATE = 0
+    SET_COLOUR_MAP_ENTRIES = 1
+    BELL = 2
+    SERVER_CUT_TEXT = 3
+
+
+class EncodingType(IntEnum):
+    RAW = 0
+    COPYRECT = 1
+    RRE = 2
+    HEXTILE = 5
+    TIGHT = 7
+    TRLE = 15
+    ZRLE = 16
+
+
+class KeySym(IntEnum):
+    """The X11 keysyms used by the RFB KeyEvent message."""
+
+    BACKSPACE = 0xFF08
+    TAB = 0xFF09
+    RETURN = 0xFF0D
+    ESCAPE = 0xFF1B
+    INSERT = 0xFF63
+    DELETE = 0xFFFF
+    HOME = 0xFF50
+    LEFT = 0xFF51
+    UP = 0xFF52
+    RIGHT = 0xFF53
+    DOWN = 0xFF54
+    PAGE_UP = 0xFF55
+    PAGE_DOWN = 0xFF56
+    END = 0xFF57
+    F1 = 0xFFBE
+    F2 = 0xFFBF
+    F3 = 0xFFC0
+    F4 = 0xFFC1
+    F5 = 0xFFC2
+    F6 = 0xFFC3
+    F7 = 0xFFC4
+    F8 = 0xFFC5
+    F9 = 0xFFC6
+    F10 = 0xFFC7
+    F11 = 0xFFC8
+    F12 = 0xFFC9
+    SHIFT_L = 0xFFE1
+    SHIFT_R = 0xFFE2
+    CONTROL_L = 0xFFE3
+    CONTROL_R = 0xFFE4
+    META_L = 0xFFE7
+    META_R = 0xFFE8
+    ALT_L = 0xFFE9
+    ALT_R = 0xFFEA
+
+
+class PixelFormat:
+    """The 16-byte PIXEL_FORMAT structure from the RFB spec.
+
+    ``pack()`` is called on every ServerInit and whenever the format is
+    re-sent; since the format rarely changes over the life of a session,
+    the packed bytes are cached and invalidated by ``__setattr__`` when
+    any field is written.  The common case is a single attribute read
+    returning a pre-built ``bytes`` object.
+    """
+
+    FORMAT = "!BBBBHHHBBBxxx"
+
+    def __init__(self, bits_per_pixel=32, depth=24, big_endian=0,
+                 true_colour=1, red_max=255, green_max=255, blue_max=255,
+                 red_shift=16, green_shift=8, blue_shift=0):
+        self.bits_per_pixel = bits_per_pixel
+        self.depth = depth
+        self.big_endian = big_endian
+        self.true_colour = true_colour
+        self.red_max = red_max
+        self.green_max = green_max
+        self.blue_max = blue_max
+        self.red_shift = red_shift
+        self.green_shift = green_shift
+        self.blue_shift = blue_shift
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name != "_packed":
+            super().__setattr__("_packed", None)
+
+    def pack(self) -> bytes:
+        packed = self._packed
+        if packed is None:
+            packed = struct.pack(
+                self.FORMAT,
+                self.bits_per_pixel, self.depth, self.big_endian,
+                self.true_colour, self.red_max, self.green_max,
+                self.blue_max, self.red_shift, self.green_shift,
+                self.blue_shift,
+            )
+            super().__setattr__("_packed", packed)
+        return packed
+
+    @classmethod
+    def unpack(cls, data: bytes) -> "PixelFormat":
+        fields = struct.unpack(cls.FORMAT, data[:16])
+        return cls(*fields)
+
+    def __eq__(self, other):
+        return isinstance(other, PixelFormat) and self.pack() == other.pack()
+
+    def __repr__(self):
+        return (f"PixelFormat(bpp={self.bits_per_pixel}, depth={self.depth}, "
+                f"rgb_max=({self.red_max},{self.green_max},{self.blue_max}), "
+                f"rgb_shift=({self.red_shift},{self.green_shift},"
+                f"{self.blue_shift}))")
+
+
+class Rectangle:
+    """One rectangle of a FramebufferUpdate message."""
+
+    def __init__(self, x: int, y: int, width: int, height: int,
+                 encoding: int = EncodingType.RAW, data: bytes = b""):
+        self.x = x
+        self.y = y
+        self.width = width
+        self.height = height
+        self.encoding = encoding
+        self.data = data
+
+    def pack_header(self) -> bytes:
+        return _RECT_HDR.pack(self.x, self.y, self.width, self.height,
+                              int(self.encoding))
+
+    def pack(self) -> bytes:
+        return self.pack_header() + self.data
+
+
+class FramebufferUpdate:
+    """A complete server-to-client FramebufferUpdate message."""
+
+    def __init__(self, rectangles: Optional[List[Rectangle]] = None):
+        self.rectangles = rectangles if rectangles is not None else []
+
+    def pack(self) -> bytes:
+        # Pack straight into one preallocated buffer instead of joining
+        # per-rectangle intermediates.
+        size = _FBU_HDR.size + sum(_RECT_HDR.size + len(rect.data)
+                                   for rect in self.rectangles)
+        buf = bytearray(size)
+        _FBU_HDR.pack_into(buf, 0, int(ServerMessage.FRAMEBUFFER_UPDATE),
+                           len(self.rectangles))
+        offset = _FBU_HDR.size
+        for rect in self.rectangles:
+            _RECT_HDR.pack_into(buf, offset, rect.x, rect.y, rect.width,
+                                rect.height, int(rect.encoding))
+            offset += _RECT_HDR.size
+            buf[offset:offset + len(rect.data)] = rect.data
+            offset += len(rect.data)
+        return bytes(buf)
+
+
+def rgb888_to_rgb565(r: int, g: int, b: int) -> int:
+    """Pack one 8-bit-per-channel RGB triple into a 16-bit 5-6-5 value."""
+    return ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
+
+
+def rgb888_to_rgb565_array(arr):
+    """Vectorized :func:`rgb888_to_rgb565` over an ``(H, W, 3)`` uint8
+    array, returning ``(H, W)`` uint16.
+
+    One NumPy pass over the image replaces a Python-level call per pixel,
+    which is what makes 16bpp framebuffer conversion viable at full
+    frame sizes.
+    """
+    if not HAS_NUMPY:
+        raise RuntimeError("rgb888_to_rgb565_array requires NumPy")
+    r = arr[..., 0].astype(np.uint16)
+    g = arr[..., 1].astype(np.uint16)
+    b = arr[..., 2].astype(np.uint16)
+    return ((r & 0xF8) << 8) | ((g & 0xFC) << 3) | (b >> 3)
+
+
+class VNCAuth:
+    """VNC challenge-response authentication (security type 2)."""
+
+    CHALLENGE_SIZE = 16
+
+    @staticmethod
+    def make_challenge() -> bytes:
+        return os.urandom(VNCAuth.CHALLENGE_SIZE)
+
+    @staticmethod
+    def _password_key(password: str) -> bytes:
+        """VNC uses the password, zero-padded/truncated to 8 bytes, with
+        the bits of each byte reversed, as the DES key."""
+        key = password.encode("latin-1")[:8].ljust(8, b"\x00")
+        return bytes(int(f"{byte:08b}"[::-1], 2) for byte in key)
+
+    @staticmethod
+    def derive_subkeys(password: str):
+        """Expand the password into DES subkeys.  These depend only on
+        the password, so long-lived holders (the server) derive them once
+        and reuse them for every challenge."""
+        return des.key_schedule(VNCAuth._password_key(password))
+
+    @staticmethod
+    def encrypt_with_subkeys(challenge: bytes, subkeys) -> bytes:
+        return b"".join(
+            des.encrypt_block(challenge[i:i + 8], subkeys)
+            for i in range(0, len(challenge), 8))
+
+    @staticmethod
+    def encrypt_challenge(challenge: bytes, password: str) -> bytes:
+        return VNCAuth.encrypt_with_subkeys(
+            challenge, VNCAuth.derive_subkeys(password))
+
+    @staticmethod
+    def check_response(challenge: bytes, response: bytes,
+                       password: str) -> bool:
+        return VNCAuth.encrypt_challenge(challenge, password) == response
+
+
+class RFBProtocol:
+    """Blocking reader/writer for RFB protocol fields over a socket.
+
+    Reads go through a 64KB buffer filled with ``recv_into``: one bulk
+    recv typically serves many small header/field reads, so the per-field
+    cost is a couple of index operations instead of a syscall plus a
+    fresh ``bytes`` allocation.
+    """
+
+    RECV_BUFFER_SIZE = 65536
+
+    def __init__(self, sock):
+        self.socket = sock
+        self._buf = bytearray(self.RECV_BUFFER_SIZE)
+        self._mv = memoryview(self._buf)
+        self._head = 0
+        self._tail = 0
+
+    def send_data(self, data: bytes) -> None:
+        self.socket.sendall(data)
+
+    def _fill(self) -> None:
+        """Pull at least one byte from the socket into the buffer."""
+        if self._head == self._tail:
+            self._head = self._tail = 0
+        elif self._tail == len(self._buf):
+            # compact pending bytes to the front to make room
+            pending = self._tail - self._head
+            self._mv[:pending] = self._mv[self._head:self._tail]
+            self._head, self._tail = 0, pending
+        received = self.socket.recv_into(self._mv[self._tail:])
+        if received == 0:
+            raise ConnectionError("connection closed by peer")
+        self._tail += received
+
+    def _need(self, size: int) -> None:
+        while self._tail - self._head < size:
+            self._fill()
+
+    @property
+    def buffered(self) -> int:
+        """Bytes already read from the socket but not yet consumed."""
+        return self._tail - self._head
+
+    def receive_data(self, size: int) -> bytes:
+        if size <= len(self._buf):
+            self._need(size)
+            data = bytes(self._mv[self._head:self._head + size])
+            self._head += size
+            return data
+        # payload larger than the buffer: recv straight into the output
+        # to avoid double copies
+        out = bytearray(size)
+        self.recv_exact_into(memoryview(out), size)
+        return bytes(out)
+
+    def recv_exact_into(self, view, size: int) -> None:
+        """Fill ``view[:size]`` exactly, draining buffered bytes first.
+
+        MSG_WAITALL asks the kernel to return only once the request is
+        satisfied, so a large pixel payload usually costs one syscall
+        instead of one per network read.
+        """
+        pending = self._tail - self._head
+        filled = min(pending, size)
+        if filled:
+            view[:filled] = self._mv[self._head:self._head + filled]
+            self._head += filled
+        while filled < size:
+            received = self.socket.recv_into(view[filled:size],
+                                             size - filled,
+                                             _socket.MSG_WAITALL)
+            if received == 0:
+                raise ConnectionError("connection closed by peer")
+            filled += received
+
+    def send_uint8(self, value: int) -> None:
+        self.send_data(_U8.pack(value))
+
+    def send_uint16(self, value: int) -> None:
+        self.send_data(_U16.pack(value))
+
+    def send_uint32(self, value: int) -> None:
+        self.send_data(_U32.pack(value))
+
+    def receive_uint8(self) -> int:
+        self._need(1)
+        value = self._buf[self._head]
+        self._head += 1
+        return value
+
+    def receive_uint16(self) -> int:
+        self._need(2)
+        head = self._head
+        value = int.from_bytes(self._mv[head:head + 2], "big")
+        self._head = head + 2
+        return value
+
+    def receive_uint32(self) -> int:
+        self._need(4)
+        head = self._head
+        value = int.from_bytes(self._mv[head:head + 4], "big")
+        self._head = head + 4
+        return value
@@ -0,0 +1 @@
+"""The VNC server implementation."""